@@ -0,0 +1,1460 @@
+import { buildRelayWsUrl, isRetryableReconnectError, isSkippableUrl, reconnectDelayMs } from './background-utils.js'
+
+const DEFAULT_PORT = 18792
+const startedAt = Date.now()
+
+const BADGE = {
+  on: { text: 'ON', color: '#16a34a' },
+  off: { text: '', color: '#000000' },
+  connecting: { text: '\u2026', color: '#F59E0B' },
+  error: { text: '!', color: '#B91C1C' },
+}
+
+/** @type {WebSocket|null} */
+let relayWs = null
+/** @type {Promise<void>|null} */
+let relayConnectPromise = null
+let relayGatewayToken = ''
+/** @type {string|null} */
+let relayConnectRequestId = null
+
+// CDP event batching. Only used when the relay lists EVENT_BATCH_CAP in its
+// connect response; otherwise every event goes out as its own forwardCDPEvent.
+const EVENT_BATCH_CAP = 'forwardCDPEventBatch'
+const EVENT_BATCH_MAX = 50
+const EVENT_BATCH_FLUSH_MS = 10
+// Session lifecycle events skip the queue so the relay learns about sessions promptly.
+const UNBATCHED_EVENTS = new Set(['Target.attachedToTarget', 'Target.detachedFromTarget'])
+let relayEventBatching = false
+/** Queued events as [sessionId, method, params] tuples (the batch wire format). @type {[string, string, any][]} */
+const pendingEvents = []
+/** @type {ReturnType<typeof setTimeout>|null} */
+let eventFlushTimer = null
+
+let nextSession = 1
+
+/** @type {Map<number, {state:'connecting'|'connected', sessionId?:string, targetId?:string, attachOrder?:number, url?:string, title?:string, attachedAt?:number}>} */
+const tabs = new Map()
+/** @type {Map<string, number>} */
+const tabBySession = new Map()
+/** @type {Map<string, number>} */
+const tabByTarget = new Map()
+/** Number of `tabs` entries in the 'connected' state; kept in sync by setTabEntry/deleteTabEntry. */
+let attachedCount = 0
+/** @type {Map<string, number>} */
+const childSessionToTab = new Map()
+/** Reverse of childSessionToTab: per-tab cleanup only touches that tab's children. @type {Map<number, Set<string>>} */
+const tabToChildSessions = new Map()
+
+/**
+ * Tabs that are not attached but could be, with their last known URL. Kept
+ * current by the tab listeners so keepalive retries only these.
+ * @type {Map<number, string>}
+ */
+const unattachedTabs = new Map()
+
+/** @type {Map<number, {resolve:(v:any)=>void, reject:(e:Error)=>void}>} */
+const pending = new Map()
+
+/** @type {Set<number>} */
+const tabOperationLocks = new Set()
+/** @type {Set<number>} */
+const reattachPending = new Set()
+
+// Navigation reattach backoff: full jitter over a capped exponential. A tab that
+// detaches again within the streak window resumes from a higher exponent.
+const REATTACH_ATTEMPTS = 3
+const REATTACH_BASE_MS = 300
+const REATTACH_CAP_MS = 2000
+const REATTACH_STREAK_WINDOW_MS = 5000
+/** @type {Map<number, {streak:number, at:number}>} */
+const reattachBackoff = new Map()
+
+let reconnectAttempt = 0
+let reconnectTimer = null
+
+// --- Tab Registry ---
+
+function setTabEntry(tabId, tab) {
+  const prev = tabs.get(tabId)
+  if (prev) forgetTabEntry(tabId, prev)
+  tabs.set(tabId, tab)
+  unattachedTabs.delete(tabId)
+  if (tab.state === 'connected') attachedCount++
+  if (tab.targetId) tabByTarget.set(tab.targetId, tabId)
+}
+
+function deleteTabEntry(tabId) {
+  const prev = tabs.get(tabId)
+  if (!prev) return undefined
+  forgetTabEntry(tabId, prev)
+  tabs.delete(tabId)
+  noteUnattached(tabId, prev.url)
+  return prev
+}
+
+/** Drops a tab's record plus its session and child-session indexes; returns the old record. */
+function evictTab(tabId) {
+  const tab = deleteTabEntry(tabId)
+  if (!tab) return null
+  if (tab.sessionId) tabBySession.delete(tab.sessionId)
+  takeChildSessions(tabId)
+  return tab
+}
+
+function noteUnattached(tabId, url) {
+  if (tabs.has(tabId)) return
+  if (isSkippableUrl(url)) unattachedTabs.delete(tabId)
+  else unattachedTabs.set(tabId, url)
+}
+
+function forgetTabEntry(tabId, tab) {
+  if (tab.state === 'connected') attachedCount--
+  if (tab.targetId && tabByTarget.get(tab.targetId) === tabId) tabByTarget.delete(tab.targetId)
+}
+
+function addChildSession(sessionId, tabId) {
+  const prevTabId = childSessionToTab.get(sessionId)
+  if (prevTabId !== undefined && prevTabId !== tabId) tabToChildSessions.get(prevTabId)?.delete(sessionId)
+  childSessionToTab.set(sessionId, tabId)
+  let sessions = tabToChildSessions.get(tabId)
+  if (!sessions) tabToChildSessions.set(tabId, (sessions = new Set()))
+  sessions.add(sessionId)
+}
+
+function removeChildSession(sessionId) {
+  const tabId = childSessionToTab.get(sessionId)
+  if (tabId === undefined) return
+  childSessionToTab.delete(sessionId)
+  const sessions = tabToChildSessions.get(tabId)
+  if (!sessions) return
+  sessions.delete(sessionId)
+  if (sessions.size === 0) tabToChildSessions.delete(tabId)
+}
+
+const NO_CHILD_SESSIONS = Object.freeze([])
+
+/**
+ * Drops every child session of `tabId` and returns their ids. The returned Set
+ * is already unlinked from the index, so it is handed back without copying.
+ * @returns {Iterable<string>}
+ */
+function takeChildSessions(tabId) {
+  const sessions = tabToChildSessions.get(tabId)
+  if (!sessions) return NO_CHILD_SESSIONS
+  tabToChildSessions.delete(tabId)
+  for (const sessionId of sessions) childSessionToTab.delete(sessionId)
+  return sessions
+}
+
+// --- Settings ---
+
+const SETTINGS_KEYS = ['relayPort', 'gatewayToken', 'autoAttach']
+
+/** @type {Promise<Record<string, any>>|null} */
+let settingsPromise = null
+
+function getSettings() {
+  if (!settingsPromise) {
+    settingsPromise = chrome.storage.local.get(SETTINGS_KEYS).catch((err) => {
+      settingsPromise = null
+      throw err
+    })
+  }
+  return settingsPromise
+}
+
+/** Mirrors the autoAttach setting so hot paths can check it without a storage round-trip. */
+let autoAttachEnabled = true
+
+async function loadAutoAttachSetting() {
+  try {
+    const stored = await getSettings()
+    autoAttachEnabled = stored.autoAttach !== false
+  } catch {
+    // Keep the default
+  }
+}
+
+chrome.storage.onChanged.addListener((changes, area) => {
+  if (area !== 'local') return
+  settingsPromise = null
+  if (changes.autoAttach) autoAttachEnabled = changes.autoAttach.newValue !== false
+})
+
+function parseRelayPort(value) {
+  const n = Number.parseInt(String(value || ''), 10)
+  if (!Number.isFinite(n) || n <= 0 || n > 65535) return DEFAULT_PORT
+  return n
+}
+
+function isAutoAttachEnabled() {
+  return autoAttachEnabled
+}
+
+// --- Badge ---
+
+// Badge updates are batched onto the microtask queue, so a burst of setBadge()
+// and updateGlobalBadge() calls in one turn renders each badge once.
+
+/** @type {Map<number, keyof typeof BADGE>} */
+const pendingBadges = new Map()
+let badgesPending = false
+let globalBadgePending = false
+
+function setBadge(tabId, kind) {
+  pendingBadges.set(tabId, kind)
+  if (badgesPending) return
+  badgesPending = true
+  queueMicrotask(flushBadges)
+}
+
+function flushBadges() {
+  badgesPending = false
+  for (const [tabId, kind] of pendingBadges) {
+    const cfg = BADGE[kind]
+    void chrome.action.setBadgeText({ tabId, text: cfg.text })
+    void chrome.action.setBadgeBackgroundColor({ tabId, color: cfg.color })
+    void chrome.action.setBadgeTextColor({ tabId, color: '#FFFFFF' }).catch(() => {})
+  }
+  pendingBadges.clear()
+}
+
+function updateGlobalBadge() {
+  if (globalBadgePending) return
+  globalBadgePending = true
+  queueMicrotask(() => {
+    globalBadgePending = false
+    renderGlobalBadge()
+  })
+}
+
+function renderGlobalBadge() {
+  const wsConnected = relayWs && relayWs.readyState === WebSocket.OPEN
+
+  const text = attachedCount > 0 ? String(attachedCount) : ''
+  let color
+  if (wsConnected && attachedCount > 0) {
+    color = '#16a34a'
+  } else if (wsConnected) {
+    color = '#F59E0B'
+  } else {
+    color = '#B91C1C'
+  }
+
+  void chrome.action.setBadgeText({ text })
+  void chrome.action.setBadgeBackgroundColor({ color })
+  void chrome.action.setBadgeTextColor({ color: '#FFFFFF' }).catch(() => {})
+}
+
+// --- State Persistence ---
+
+const PERSIST_DEBOUNCE_MS = 250
+/** @type {ReturnType<typeof setTimeout>|null} */
+let persistTimer = null
+
+/**
+ * Coalesces persist requests arriving within PERSIST_DEBOUNCE_MS of the first
+ * into one chrome.storage.session write. The snapshot is taken when the timer
+ * fires, so the last change before it always lands. The global badge is not
+ * part of the debounce and refreshes right away.
+ */
+function schedulePersist() {
+  updateGlobalBadge()
+  if (persistTimer) return
+  persistTimer = setTimeout(() => {
+    persistTimer = null
+    void persistStateNow()
+  }, PERSIST_DEBOUNCE_MS)
+}
+
+function flushPersist() {
+  if (!persistTimer) return
+  clearTimeout(persistTimer)
+  persistTimer = null
+  void persistStateNow()
+}
+
+async function persistStateNow() {
+  try {
+    const tabEntries = []
+    for (const [tabId, tab] of tabs.entries()) {
+      if (tab.state === 'connected' && tab.sessionId && tab.targetId) {
+        tabEntries.push({
+          tabId,
+          sessionId: tab.sessionId,
+          targetId: tab.targetId,
+          attachOrder: tab.attachOrder ?? 0,
+        })
+      }
+    }
+    await chrome.storage.session.set({ persistedTabs: tabEntries, nextSession })
+  } catch {
+    // chrome.storage.session may not be available
+  }
+}
+
+async function rehydrateState() {
+  try {
+    const stored = await chrome.storage.session.get(['persistedTabs', 'nextSession'])
+    if (stored.nextSession) {
+      nextSession = Math.max(nextSession, stored.nextSession)
+    }
+    // Session storage is the only place keys come from outside this worker;
+    // keep `tabs` numeric- and the session/target indexes string-keyed.
+    const entries = (stored.persistedTabs || []).filter(
+      (entry) =>
+        Number.isInteger(entry?.tabId) &&
+        typeof entry.sessionId === 'string' &&
+        typeof entry.targetId === 'string',
+    )
+    for (const entry of entries) {
+      setTabEntry(entry.tabId, {
+        state: 'connected',
+        sessionId: entry.sessionId,
+        targetId: entry.targetId,
+        attachOrder: entry.attachOrder,
+      })
+      tabBySession.set(entry.sessionId, entry.tabId)
+      setBadge(entry.tabId, 'on')
+    }
+    for (const entry of entries) {
+      try {
+        await chrome.tabs.get(entry.tabId)
+        await chrome.debugger.sendCommand({ tabId: entry.tabId }, 'Runtime.evaluate', {
+          expression: '1',
+          returnByValue: true,
+        })
+      } catch {
+        deleteTabEntry(entry.tabId)
+        tabBySession.delete(entry.sessionId)
+        setBadge(entry.tabId, 'off')
+      }
+    }
+  } catch {
+    // Ignore rehydration errors
+  }
+  updateGlobalBadge()
+}
+
+// --- WebSocket Relay ---
+
+async function ensureRelayConnection() {
+  if (relayWs && relayWs.readyState === WebSocket.OPEN) return
+  if (relayConnectPromise) return await relayConnectPromise
+
+  relayConnectPromise = (async () => {
+    const settings = await getSettings()
+    const port = parseRelayPort(settings.relayPort)
+    const gatewayToken = String(settings.gatewayToken || '').trim()
+    const httpBase = `http://127.0.0.1:${port}`
+    const wsUrl = await buildRelayWsUrl(port, gatewayToken)
+
+    try {
+      await fetch(`${httpBase}/`, { method: 'HEAD', signal: AbortSignal.timeout(2000) })
+    } catch (err) {
+      throw new Error(`Relay server not reachable at ${httpBase} (${String(err)})`)
+    }
+
+    const ws = new WebSocket(wsUrl)
+    relayWs = ws
+    relayGatewayToken = gatewayToken
+
+    ws.onmessage = (event) => {
+      if (ws !== relayWs) return
+      void whenReady(() => onRelayMessage(String(event.data || '')))
+    }
+
+    await new Promise((resolve, reject) => {
+      const t = setTimeout(() => reject(new Error('WebSocket connect timeout')), 5000)
+      ws.onopen = () => {
+        clearTimeout(t)
+        resolve()
+      }
+      ws.onerror = () => {
+        clearTimeout(t)
+        reject(new Error('WebSocket connect failed'))
+      }
+      ws.onclose = (ev) => {
+        clearTimeout(t)
+        reject(new Error(`WebSocket closed (${ev.code} ${ev.reason || 'no reason'})`))
+      }
+    })
+
+    ws.onclose = () => {
+      if (ws !== relayWs) return
+      onRelayClosed('closed')
+    }
+    ws.onerror = () => {
+      if (ws !== relayWs) return
+      onRelayClosed('error')
+    }
+  })()
+
+  try {
+    await relayConnectPromise
+    reconnectAttempt = 0
+    updateKeepalive()
+    updateGlobalBadge()
+  } finally {
+    relayConnectPromise = null
+  }
+}
+
+function onRelayClosed(reason) {
+  relayWs = null
+  relayGatewayToken = ''
+  relayConnectRequestId = null
+  relayEventBatching = false
+  pendingEvents.length = 0
+  if (eventFlushTimer) {
+    clearTimeout(eventFlushTimer)
+    eventFlushTimer = null
+  }
+
+  const inflight = [...pending.values()]
+  pending.clear()
+  for (const p of inflight) {
+    p.reject(new Error(`Relay disconnected (${reason})`))
+  }
+
+  reattachPending.clear()
+  updateKeepalive()
+  updateGlobalBadge()
+
+  for (const [tabId, tab] of tabs.entries()) {
+    if (tab.state === 'connected') {
+      setBadge(tabId, 'connecting')
+    }
+  }
+
+  scheduleReconnect()
+}
+
+function scheduleReconnect() {
+  if (reconnectTimer) {
+    clearTimeout(reconnectTimer)
+    reconnectTimer = null
+  }
+
+  const delay = reconnectDelayMs(reconnectAttempt)
+  reconnectAttempt++
+
+  console.log(`Scheduling reconnect attempt ${reconnectAttempt} in ${Math.round(delay)}ms`)
+
+  reconnectTimer = setTimeout(async () => {
+    reconnectTimer = null
+    try {
+      await ensureRelayConnection()
+      reconnectAttempt = 0
+      console.log('Reconnected successfully')
+      await reannounceAttachedTabs()
+    } catch (err) {
+      const message = err instanceof Error ? err.message : String(err)
+      console.warn(`Reconnect attempt ${reconnectAttempt} failed: ${message}`)
+      if (!isRetryableReconnectError(err)) return
+      scheduleReconnect()
+    }
+  }, delay)
+}
+
+function cancelReconnect() {
+  if (reconnectTimer) {
+    clearTimeout(reconnectTimer)
+    reconnectTimer = null
+  }
+  reconnectAttempt = 0
+}
+
+async function reannounceAttachedTabs() {
+  for (const [tabId, tab] of tabs.entries()) {
+    if (tab.state !== 'connected' || !tab.sessionId || !tab.targetId) continue
+
+    try {
+      await chrome.debugger.sendCommand({ tabId }, 'Runtime.evaluate', {
+        expression: '1',
+        returnByValue: true,
+      })
+    } catch {
+      deleteTabEntry(tabId)
+      if (tab.sessionId) tabBySession.delete(tab.sessionId)
+      setBadge(tabId, 'off')
+      continue
+    }
+
+    try {
+      const info = /** @type {any} */ (
+        await chrome.debugger.sendCommand({ tabId }, 'Target.getTargetInfo')
+      )
+      sendCdpEvent('Target.attachedToTarget', {
+        sessionId: tab.sessionId,
+        targetInfo: { ...info?.targetInfo, attached: true },
+        waitingForDebugger: false,
+      })
+      setBadge(tabId, 'on')
+    } catch {
+      setBadge(tabId, 'on')
+    }
+  }
+
+  schedulePersist()
+}
+
+function sendToRelay(payload) {
+  sendToRelayRaw(JSON.stringify(payload))
+}
+
+function sendToRelayRaw(text) {
+  const ws = relayWs
+  if (!ws || ws.readyState !== WebSocket.OPEN) {
+    throw new Error('Relay not connected')
+  }
+  // Anything sent directly must not overtake events still in the batch queue.
+  if (pendingEvents.length > 0) flushCdpEvents()
+  ws.send(text)
+}
+
+const TARGET_DETACHED_PREFIX =
+  '{"method":"forwardCDPEvent","params":{"method":"Target.detachedFromTarget","params":{"sessionId":'
+
+/**
+ * Announces a detached session. Only sessionId, targetId and reason vary, so
+ * the rest of the frame is a constant string. No-op while the relay is down.
+ */
+function sendTargetDetached(sessionId, targetId, reason) {
+  if (!relayWs || relayWs.readyState !== WebSocket.OPEN) return
+  const target = targetId === undefined ? '' : `,"targetId":${JSON.stringify(targetId)}`
+  sendToRelayRaw(`${TARGET_DETACHED_PREFIX}${JSON.stringify(sessionId)}${target},"reason":${JSON.stringify(reason)}}}}`)
+}
+
+function queueCdpEvent(method, params, sessionId) {
+  pendingEvents.push([sessionId, method, params])
+  if (pendingEvents.length >= EVENT_BATCH_MAX) flushCdpEvents()
+  else eventFlushTimer ??= setTimeout(flushCdpEvents, EVENT_BATCH_FLUSH_MS)
+}
+
+function flushCdpEvents() {
+  if (eventFlushTimer) {
+    clearTimeout(eventFlushTimer)
+    eventFlushTimer = null
+  }
+  if (pendingEvents.length === 0) return
+  const events = pendingEvents.splice(0)
+  const ws = relayWs
+  if (!ws || ws.readyState !== WebSocket.OPEN) return
+  ws.send(JSON.stringify({ method: EVENT_BATCH_CAP, params: { events } }))
+}
+
+/**
+ * Sends a `forwardCDPEvent` frame. The constant envelope is written as a
+ * string so only the event's own params go through JSON.stringify.
+ */
+function sendCdpEvent(method, params, sessionId) {
+  const session = sessionId === undefined ? '' : `"sessionId":${JSON.stringify(sessionId)},`
+  const body = params === undefined ? '' : `,"params":${JSON.stringify(params)}`
+  sendToRelayRaw(`{"method":"forwardCDPEvent","params":{${session}"method":${JSON.stringify(method)}${body}}}`)
+}
+
+function ensureGatewayHandshakeStarted(payload) {
+  if (relayConnectRequestId) return
+  const nonce = typeof payload?.nonce === 'string' ? payload.nonce.trim() : ''
+  relayConnectRequestId = `ext-connect-${Date.now()}-${Math.random().toString(16).slice(2, 8)}`
+  sendToRelay({
+    type: 'req',
+    id: relayConnectRequestId,
+    method: 'connect',
+    params: {
+      minProtocol: 3,
+      maxProtocol: 3,
+      client: {
+        id: 'chrome-relay-extension',
+        version: '1.0.0',
+        platform: 'chrome-extension',
+        mode: 'webchat',
+      },
+      role: 'operator',
+      scopes: ['operator.read', 'operator.write'],
+      caps: [],
+      commands: [],
+      nonce: nonce || undefined,
+      auth: relayGatewayToken ? { token: relayGatewayToken } : undefined,
+    },
+  })
+}
+
+// --- Tab Attach / Detach ---
+
+async function attachTab(tabId, opts = {}) {
+  const debuggee = { tabId }
+  await chrome.debugger.attach(debuggee, '1.3')
+  await chrome.debugger.sendCommand(debuggee, 'Page.enable').catch(() => {})
+
+  const info = /** @type {any} */ (await chrome.debugger.sendCommand(debuggee, 'Target.getTargetInfo'))
+  const targetInfo = info?.targetInfo
+  const targetId = String(targetInfo?.targetId || '').trim()
+  if (!targetId) throw new Error('Target.getTargetInfo returned no targetId')
+
+  const sid = nextSession++
+  const sessionId = `cb-tab-${sid}`
+
+  const tabInfo = await chrome.tabs.get(tabId).catch(() => null)
+
+  setTabEntry(tabId, {
+    state: 'connected',
+    sessionId,
+    targetId,
+    attachOrder: sid,
+    url: tabInfo?.url || targetInfo?.url || '',
+    title: tabInfo?.title || targetInfo?.title || '',
+    attachedAt: Date.now(),
+  })
+  tabBySession.set(sessionId, tabId)
+
+  if (!opts.skipAttachedEvent) {
+    try {
+      sendCdpEvent('Target.attachedToTarget', {
+        sessionId,
+        targetInfo: { ...targetInfo, attached: true },
+        waitingForDebugger: false,
+      })
+    } catch {
+      // Relay may be down — we'll reannounce on reconnect
+    }
+  }
+
+  setBadge(tabId, 'on')
+  schedulePersist()
+
+  return { sessionId, targetId }
+}
+
+async function detachTab(tabId, reason) {
+  const tab = tabs.get(tabId)
+
+  for (const childSessionId of takeChildSessions(tabId)) {
+    sendTargetDetached(childSessionId, undefined, 'parent_detached')
+  }
+
+  if (tab?.sessionId && tab?.targetId) {
+    sendTargetDetached(tab.sessionId, tab.targetId, reason)
+  }
+
+  if (tab?.sessionId) tabBySession.delete(tab.sessionId)
+  deleteTabEntry(tabId)
+
+  try {
+    await chrome.debugger.detach({ tabId })
+  } catch {
+    // May already be detached
+  }
+
+  setBadge(tabId, 'off')
+  schedulePersist()
+}
+
+// --- Auto-Attach Logic ---
+
+// Bulk attaches (startup, session restore, keepalive catch-up) are capped so a
+// large window doesn't burst chrome.debugger.attach.
+const ATTACH_CONCURRENCY = 4
+
+/** Runs `fn` over `items` with at most `limit` calls in flight; errors are swallowed. */
+async function mapLimit(items, limit, fn) {
+  const it = items[Symbol.iterator]()
+  const workers = Array.from({ length: limit }, async () => {
+    for (const item of it) {
+      try {
+        await fn(item)
+      } catch {
+        // Callers handle their own failures
+      }
+    }
+  })
+  await Promise.all(workers)
+}
+
+async function autoAttachAllTabs() {
+  if (!isAutoAttachEnabled()) return
+
+  const allTabs = await chrome.tabs.query({})
+  const ownOptionsUrl = chrome.runtime.getURL('options.html')
+
+  const eligible = allTabs.filter(
+    (tab) => tab.id && !tabs.has(tab.id) && !isSkippableUrl(tab.url) && tab.url !== ownOptionsUrl,
+  )
+  for (const tab of eligible) unattachedTabs.set(tab.id, tab.url)
+
+  await mapLimit(eligible, ATTACH_CONCURRENCY, async (tab) => {
+    if (tabs.has(tab.id) || tabOperationLocks.has(tab.id)) return
+    tabOperationLocks.add(tab.id)
+    try {
+      await attachTab(tab.id)
+    } catch (err) {
+      const msg = err instanceof Error ? err.message : String(err)
+      console.warn(`Auto-attach failed for tab ${tab.id} (${tab.url}): ${msg}`)
+    } finally {
+      tabOperationLocks.delete(tab.id)
+    }
+  })
+}
+
+async function autoAttachTab(tabId, url) {
+  if (!isAutoAttachEnabled()) return
+  if (tabs.has(tabId)) return
+  const ownOptionsUrl = chrome.runtime.getURL('options.html')
+  if (isSkippableUrl(url) || url === ownOptionsUrl) {
+    unattachedTabs.delete(tabId)
+    return
+  }
+  if (tabOperationLocks.has(tabId)) return
+  if (reattachPending.has(tabId)) return
+
+  try {
+    await ensureRelayConnection()
+  } catch {
+    return
+  }
+
+  tabOperationLocks.add(tabId)
+  try {
+    await attachTab(tabId)
+  } catch (err) {
+    const msg = err instanceof Error ? err.message : String(err)
+    console.warn(`Auto-attach failed for tab ${tabId}: ${msg}`)
+  } finally {
+    tabOperationLocks.delete(tabId)
+  }
+}
+
+// --- Action Click (toggle all attach/detach) ---
+
+async function onActionClicked() {
+  if (attachedCount > 0) {
+    const ids = Array.from(tabs.keys())
+    await Promise.all(ids.map((tabId) => detachTab(tabId, 'toggle').catch(() => {})))
+  } else {
+    cancelReconnect()
+    try {
+      await ensureRelayConnection()
+      await autoAttachAllTabs()
+    } catch (err) {
+      const msg = err instanceof Error ? err.message : String(err)
+      console.warn('Attach all failed:', msg)
+    }
+  }
+}
+
+// --- Relay Message Handling ---
+
+async function onRelayMessage(text) {
+  /** @type {any} */
+  let msg
+  try {
+    msg = JSON.parse(text)
+  } catch {
+    return
+  }
+
+  if (msg && msg.type === 'event' && msg.event === 'connect.challenge') {
+    try {
+      ensureGatewayHandshakeStarted(msg.payload)
+    } catch (err) {
+      console.warn('gateway connect handshake start failed', err instanceof Error ? err.message : String(err))
+      relayConnectRequestId = null
+      const ws = relayWs
+      if (ws && ws.readyState === WebSocket.OPEN) {
+        ws.close(1008, 'gateway connect failed')
+      }
+    }
+    return
+  }
+
+  if (msg && msg.type === 'res' && relayConnectRequestId && msg.id === relayConnectRequestId) {
+    relayConnectRequestId = null
+    const caps = msg?.payload?.caps
+    relayEventBatching = Boolean(msg.ok) && Array.isArray(caps) && caps.includes(EVENT_BATCH_CAP)
+    if (!msg.ok) {
+      const detail = msg?.error?.message || msg?.error || 'gateway connect failed'
+      console.warn('gateway connect handshake rejected', String(detail))
+      const ws = relayWs
+      if (ws && ws.readyState === WebSocket.OPEN) {
+        ws.close(1008, 'gateway connect failed')
+      }
+    }
+    return
+  }
+
+  if (msg && msg.method === 'ping') {
+    try {
+      sendToRelay({ method: 'pong' })
+    } catch {
+      // ignore
+    }
+    return
+  }
+
+  if (msg && typeof msg.id === 'number' && (msg.result !== undefined || msg.error !== undefined)) {
+    const p = pending.get(msg.id)
+    if (!p) return
+    pending.delete(msg.id)
+    if (msg.error) p.reject(new Error(String(msg.error)))
+    else p.resolve(msg.result)
+    return
+  }
+
+  if (msg && typeof msg.id === 'number' && msg.method === 'forwardCDPCommand') {
+    try {
+      const result = await handleForwardCdpCommand(msg)
+      sendToRelay({ id: msg.id, result })
+    } catch (err) {
+      sendToRelay({ id: msg.id, error: err instanceof Error ? err.message : String(err) })
+    }
+  }
+}
+
+// --- CDP Command Router ---
+
+function getTabBySessionId(sessionId) {
+  const direct = tabBySession.get(sessionId)
+  if (direct) return { tabId: direct, kind: 'main' }
+  const child = childSessionToTab.get(sessionId)
+  if (child) return { tabId: child, kind: 'child' }
+  return null
+}
+
+function getTabByTargetId(targetId) {
+  return tabByTarget.get(targetId) ?? null
+}
+
+function resolveTabId(msg) {
+  const params = msg?.params
+  const sessionId = typeof params?.sessionId === 'string' ? params.sessionId : undefined
+  const innerParams = params?.params
+  const targetId = typeof innerParams?.targetId === 'string' ? innerParams.targetId : undefined
+
+  const bySession = sessionId ? getTabBySessionId(sessionId) : null
+  if (bySession) return bySession.tabId
+
+  if (targetId) {
+    const byTarget = getTabByTargetId(targetId)
+    if (byTarget) return byTarget
+  }
+
+  for (const [id, tab] of tabs.entries()) {
+    if (tab.state === 'connected') return id
+  }
+  return null
+}
+
+async function handleForwardCdpCommand(msg) {
+  const method = String(msg?.params?.method || '').trim()
+  const params = msg?.params?.params || undefined
+  const sessionId = typeof msg?.params?.sessionId === 'string' ? msg.params.sessionId : undefined
+
+  // --- Custom Commands ---
+
+  if (method === 'Tab.list') return handleTabList()
+  if (method === 'Tab.attachAll') {
+    await autoAttachAllTabs()
+    return handleTabList()
+  }
+  if (method === 'Tab.getStatus') return handleGetStatus()
+  if (method.startsWith('Cookie.')) return handleCookieCommand(method, params)
+  if (method.startsWith('Download.')) return handleDownloadCommand(method, params)
+
+  // --- Standard CDP ---
+
+  const tabId = resolveTabId(msg)
+  if (!tabId) throw new Error(`No attached tab for method ${method}`)
+
+  const debuggee = { tabId }
+
+  if (method === 'Runtime.enable') {
+    try {
+      await chrome.debugger.sendCommand(debuggee, 'Runtime.disable')
+      await new Promise((r) => setTimeout(r, 50))
+    } catch {
+      // ignore
+    }
+    return await chrome.debugger.sendCommand(debuggee, 'Runtime.enable', params)
+  }
+
+  if (method === 'Target.createTarget') {
+    const url = typeof params?.url === 'string' ? params.url : 'about:blank'
+    const tab = await chrome.tabs.create({ url, active: false })
+    if (!tab.id) throw new Error('Failed to create tab')
+    await new Promise((r) => setTimeout(r, 100))
+    const attached = await attachTab(tab.id)
+    return { targetId: attached.targetId }
+  }
+
+  if (method === 'Target.closeTarget') {
+    const target = typeof params?.targetId === 'string' ? params.targetId : ''
+    const toClose = target ? getTabByTargetId(target) : tabId
+    if (!toClose) return { success: false }
+    try {
+      await chrome.tabs.remove(toClose)
+    } catch {
+      return { success: false }
+    }
+    return { success: true }
+  }
+
+  if (method === 'Target.activateTarget') {
+    const target = typeof params?.targetId === 'string' ? params.targetId : ''
+    const toActivate = target ? getTabByTargetId(target) : tabId
+    if (!toActivate) return {}
+    const tab = await chrome.tabs.get(toActivate).catch(() => null)
+    if (!tab) return {}
+    if (tab.windowId) {
+      await chrome.windows.update(tab.windowId, { focused: true }).catch(() => {})
+    }
+    await chrome.tabs.update(toActivate, { active: true }).catch(() => {})
+    return {}
+  }
+
+  const tabState = tabs.get(tabId)
+  const mainSessionId = tabState?.sessionId
+  const debuggerSession =
+    sessionId && mainSessionId && sessionId !== mainSessionId
+      ? { ...debuggee, sessionId }
+      : debuggee
+
+  return await chrome.debugger.sendCommand(debuggerSession, method, params)
+}
+
+// --- Custom Command Handlers ---
+
+function handleTabList() {
+  const result = []
+  for (const [tabId, tab] of tabs.entries()) {
+    if (tab.state === 'connected' && tab.sessionId && tab.targetId) {
+      result.push({
+        tabId,
+        sessionId: tab.sessionId,
+        targetId: tab.targetId,
+        url: tab.url || '',
+        title: tab.title || '',
+        status: tab.state,
+        attachedAt: tab.attachedAt || 0,
+      })
+    }
+  }
+  return result
+}
+
+function handleGetStatus() {
+  return {
+    wsState: relayWs && relayWs.readyState === WebSocket.OPEN
+      ? 'connected'
+      : relayConnectPromise
+        ? 'connecting'
+        : 'disconnected',
+    attachedCount,
+    tabs: handleTabList(),
+    uptime: Date.now() - startedAt,
+  }
+}
+
+async function handleCookieCommand(method, params) {
+  switch (method) {
+    case 'Cookie.getAll': {
+      const details = {}
+      if (typeof params?.domain === 'string') details.domain = params.domain
+      if (typeof params?.url === 'string') details.url = params.url
+      if (typeof params?.name === 'string') details.name = params.name
+      return await chrome.cookies.getAll(details)
+    }
+    case 'Cookie.set': {
+      if (typeof params?.url !== 'string') throw new Error('Cookie.set requires url')
+      const cookie = { url: params.url }
+      if (typeof params?.name === 'string') cookie.name = params.name
+      if (typeof params?.value === 'string') cookie.value = params.value
+      if (typeof params?.domain === 'string') cookie.domain = params.domain
+      if (typeof params?.path === 'string') cookie.path = params.path
+      if (typeof params?.secure === 'boolean') cookie.secure = params.secure
+      if (typeof params?.httpOnly === 'boolean') cookie.httpOnly = params.httpOnly
+      if (typeof params?.sameSite === 'string') cookie.sameSite = params.sameSite
+      if (typeof params?.expirationDate === 'number') cookie.expirationDate = params.expirationDate
+      return await chrome.cookies.set(cookie)
+    }
+    case 'Cookie.remove': {
+      if (typeof params?.url !== 'string') throw new Error('Cookie.remove requires url')
+      if (typeof params?.name !== 'string') throw new Error('Cookie.remove requires name')
+      return await chrome.cookies.remove({ url: params.url, name: params.name })
+    }
+    case 'Cookie.export': {
+      const details = {}
+      if (typeof params?.domain === 'string') details.domain = params.domain
+      if (typeof params?.url === 'string') details.url = params.url
+      const cookies = await chrome.cookies.getAll(details)
+      return { cookies, exportedAt: Date.now() }
+    }
+    case 'Cookie.import': {
+      const cookies = params?.cookies
+      if (!Array.isArray(cookies)) throw new Error('Cookie.import requires cookies array')
+      const results = []
+      for (const c of cookies) {
+        try {
+          if (typeof c.url !== 'string') throw new Error('Missing url')
+          await chrome.cookies.set(c)
+          results.push({ success: true, name: c.name || '' })
+        } catch (err) {
+          results.push({
+            success: false,
+            name: c.name || '',
+            error: err instanceof Error ? err.message : String(err),
+          })
+        }
+      }
+      return { results }
+    }
+    default:
+      throw new Error(`Unknown cookie command: ${method}`)
+  }
+}
+
+async function handleDownloadCommand(method, params) {
+  switch (method) {
+    case 'Download.start': {
+      if (typeof params?.url !== 'string') throw new Error('Download.start requires url')
+      const options = { url: params.url }
+      if (typeof params?.filename === 'string') options.filename = params.filename
+      if (typeof params?.saveAs === 'boolean') options.saveAs = params.saveAs
+      const downloadId = await chrome.downloads.download(options)
+      return { downloadId }
+    }
+    case 'Download.list': {
+      const query = {}
+      if (typeof params?.limit === 'number') query.limit = params.limit
+      const items = await chrome.downloads.search(query)
+      return items.map((item) => ({
+        id: item.id,
+        url: item.url,
+        filename: item.filename,
+        state: item.state,
+        bytesReceived: item.bytesReceived,
+        totalBytes: item.totalBytes,
+        startTime: item.startTime,
+        endTime: item.endTime,
+      }))
+    }
+    case 'Download.getStatus': {
+      if (typeof params?.downloadId !== 'number') throw new Error('Download.getStatus requires downloadId')
+      const items = await chrome.downloads.search({ id: params.downloadId })
+      if (items.length === 0) throw new Error('Download not found')
+      const item = items[0]
+      return {
+        id: item.id,
+        url: item.url,
+        filename: item.filename,
+        state: item.state,
+        bytesReceived: item.bytesReceived,
+        totalBytes: item.totalBytes,
+        startTime: item.startTime,
+        endTime: item.endTime,
+        error: item.error,
+      }
+    }
+    case 'Download.cancel': {
+      if (typeof params?.downloadId !== 'number') throw new Error('Download.cancel requires downloadId')
+      await chrome.downloads.cancel(params.downloadId)
+      return { success: true }
+    }
+    case 'Download.open': {
+      if (typeof params?.downloadId !== 'number') throw new Error('Download.open requires downloadId')
+      await chrome.downloads.open(params.downloadId)
+      return { success: true }
+    }
+    default:
+      throw new Error(`Unknown download command: ${method}`)
+  }
+}
+
+// --- Debugger Event Handlers ---
+
+function onDebuggerEvent(source, method, params) {
+  const tabId = source.tabId
+  if (!tabId) return
+  const tab = tabs.get(tabId)
+  if (!tab?.sessionId) return
+
+  // CDP session ids are always strings, so they're used as Map keys as-is.
+  if (method === 'Target.attachedToTarget' && params?.sessionId) {
+    addChildSession(params.sessionId, tabId)
+  }
+  if (method === 'Target.detachedFromTarget' && params?.sessionId) {
+    removeChildSession(params.sessionId)
+  }
+
+  // Nothing to forward to; don't build or serialize the frame.
+  if (!relayWs || relayWs.readyState !== WebSocket.OPEN) return
+
+  const sessionId = source.sessionId || tab.sessionId
+  if (relayEventBatching && !UNBATCHED_EVENTS.has(method)) {
+    queueCdpEvent(method, params, sessionId)
+    return
+  }
+
+  try {
+    sendCdpEvent(method, params, sessionId)
+  } catch {
+    // Relay may be down
+  }
+}
+
+async function onDebuggerDetach(source, reason) {
+  const tabId = source.tabId
+  if (!tabId) return
+  const tab = tabs.get(tabId)
+  if (!tab) return
+
+  if (reason === 'canceled_by_user' || reason === 'replaced_with_devtools') {
+    void detachTab(tabId, reason)
+    return
+  }
+
+  // onUpdated keeps the record's url current, so no chrome.tabs.get here; the
+  // retry loop below still checks that the tab is alive before each attempt.
+  if (tab.url && isSkippableUrl(tab.url)) {
+    void detachTab(tabId, reason)
+    return
+  }
+
+  // Claim the tab before the first await; the handler is synchronous up to
+  // here, so a second detach can never start a parallel retry cascade.
+  if (reattachPending.has(tabId)) return
+  reattachPending.add(tabId)
+
+  const oldTab = evictTab(tabId)
+  const oldSessionId = oldTab?.sessionId
+  const oldTargetId = oldTab?.targetId
+
+  if (oldSessionId && oldTargetId) {
+    sendTargetDetached(oldSessionId, oldTargetId, 'navigation-reattach')
+  }
+
+  setBadge(tabId, 'connecting')
+  updateGlobalBadge()
+
+  const now = Date.now()
+  const prevBackoff = reattachBackoff.get(tabId)
+  const streak = prevBackoff && now - prevBackoff.at < REATTACH_STREAK_WINDOW_MS ? prevBackoff.streak + 1 : 0
+  reattachBackoff.set(tabId, { streak, at: now })
+
+  for (let attempt = 0; attempt < REATTACH_ATTEMPTS; attempt++) {
+    const delay = Math.min(REATTACH_CAP_MS, REATTACH_BASE_MS * 2 ** (streak + attempt))
+    await new Promise((r) => setTimeout(r, Math.random() * delay))
+    if (!reattachPending.has(tabId)) return
+
+    // The cached url can predate the navigation, so the alive probe also
+    // decides skippability: a closed tab or a chrome:// destination stops here.
+    let tabInfo
+    try {
+      tabInfo = await chrome.tabs.get(tabId)
+    } catch {
+      abandonReattach(tabId)
+      return
+    }
+    const currentUrl = tabInfo.pendingUrl || tabInfo.url
+    if (currentUrl && isSkippableUrl(currentUrl)) {
+      abandonReattach(tabId)
+      return
+    }
+
+    // Re-attach even without relay — we'll announce on reconnect
+    if (!relayWs || relayWs.readyState !== WebSocket.OPEN) {
+      try {
+        await attachTab(tabId, { skipAttachedEvent: true })
+        reattachPending.delete(tabId)
+        return
+      } catch {
+        // continue retries
+      }
+    }
+
+    try {
+      await attachTab(tabId)
+      reattachPending.delete(tabId)
+      return
+    } catch {
+      // continue retries
+    }
+  }
+
+  abandonReattach(tabId)
+}
+
+// The tab record was evicted when the reattach started; without a persist here
+// persistedTabs would keep it (tabs.onRemoved finds nothing left to evict).
+function abandonReattach(tabId) {
+  reattachPending.delete(tabId)
+  setBadge(tabId, 'off')
+  schedulePersist()
+}
+
+// --- Tab Lifecycle Listeners ---
+
+chrome.tabs.onCreated.addListener((tab) =>
+  void whenReady(() => {
+    if (!tab.id) return
+    noteUnattached(tab.id, tab.url)
+    if (tab.url && !isSkippableUrl(tab.url)) {
+      void autoAttachTab(tab.id, tab.url)
+    }
+  }),
+)
+
+chrome.tabs.onUpdated.addListener((tabId, changeInfo, tab) => {
+  // Most updates only carry favIconUrl, audible, discarded, ... — nothing we track.
+  if (!changeInfo.status && !changeInfo.url && !changeInfo.title) return
+  void whenReady(() => {
+    if (changeInfo.url) noteUnattached(tabId, changeInfo.url)
+    const existing = tabs.get(tabId)
+    if (existing) {
+      if (changeInfo.url) existing.url = changeInfo.url
+      if (changeInfo.title) existing.title = changeInfo.title
+    } else if (changeInfo.status === 'loading' && tab.url) {
+      void autoAttachTab(tabId, tab.url)
+    }
+  })
+})
+
+chrome.tabs.onRemoved.addListener((tabId) =>
+  void whenReady(() => {
+    // debugger.onDetach('target_closed') usually lands first and has already
+    // evicted the record into a reattach; that loop stops without persisting
+    // once the flag is gone, so persist here for it.
+    if (reattachPending.delete(tabId)) schedulePersist()
+    reattachBackoff.delete(tabId)
+    const tab = evictTab(tabId)
+    unattachedTabs.delete(tabId)
+    if (!tab) return
+    if (tab.sessionId && tab.targetId) {
+      sendTargetDetached(tab.sessionId, tab.targetId, 'tab_closed')
+    }
+    schedulePersist()
+  }),
+)
+
+chrome.tabs.onReplaced.addListener((addedTabId, removedTabId) =>
+  void whenReady(() => {
+    const tab = tabs.get(removedTabId)
+    if (!tab) {
+      const url = unattachedTabs.get(removedTabId)
+      if (unattachedTabs.delete(removedTabId)) noteUnattached(addedTabId, url)
+      return
+    }
+    deleteTabEntry(removedTabId)
+    unattachedTabs.delete(removedTabId)
+    setTabEntry(addedTabId, tab)
+    if (tab.sessionId) {
+      tabBySession.set(tab.sessionId, addedTabId)
+    }
+    const childSessions = tabToChildSessions.get(removedTabId)
+    if (childSessions) {
+      tabToChildSessions.delete(removedTabId)
+      tabToChildSessions.set(addedTabId, childSessions)
+      for (const childSessionId of childSessions) childSessionToTab.set(childSessionId, addedTabId)
+    }
+    setBadge(addedTabId, 'on')
+    schedulePersist()
+  }),
+)
+
+// --- Debugger Listeners ---
+
+chrome.debugger.onEvent.addListener((...args) => void whenReady(() => onDebuggerEvent(...args)))
+chrome.debugger.onDetach.addListener((...args) => void whenReady(() => onDebuggerDetach(...args)))
+
+// --- Action Click ---
+
+chrome.action.onClicked.addListener(() => void whenReady(() => onActionClicked()))
+
+// --- Navigation Badge Refresh ---
+
+// Chrome can't filter by frameId, but it can drop navigations before waking the
+// worker. UrlFilter has no "not these schemes" form, so this lists the schemes
+// attachable tabs use (anything isSkippableUrl lets through). A tab on a scheme
+// missing here stays attached but skips this refresh; onActivated still updates
+// its badge. Subframes are rejected before touching init state.
+const NAV_FILTER = {
+  url: [{ schemes: ['http', 'https', 'file', 'data', 'blob', 'filesystem', 'view-source', 'ftp'] }],
+}
+
+chrome.webNavigation.onCompleted.addListener(({ tabId, frameId }) => {
+  if (frameId !== 0) return
+  void whenReady(() => {
+    const tab = tabs.get(tabId)
+    if (tab?.state === 'connected') {
+      setBadge(tabId, relayWs && relayWs.readyState === WebSocket.OPEN ? 'on' : 'connecting')
+    }
+  })
+}, NAV_FILTER)
+
+chrome.tabs.onActivated.addListener(({ tabId }) =>
+  void whenReady(() => {
+    const tab = tabs.get(tabId)
+    if (tab?.state === 'connected') {
+      setBadge(tabId, relayWs && relayWs.readyState === WebSocket.OPEN ? 'on' : 'connecting')
+    }
+    updateGlobalBadge()
+  }),
+)
+
+// --- Download Auto-Accept ---
+
+chrome.downloads.onDeterminingFilename.addListener((item, suggest) => {
+  suggest({ filename: item.filename, conflictAction: 'uniquify' })
+})
+
+// --- Suspend ---
+
+// Write out any debounced state before Chrome tears the worker down.
+chrome.runtime.onSuspend.addListener(() => flushPersist())
+
+// --- Install ---
+
+chrome.runtime.onInstalled.addListener(() => {
+  void chrome.runtime.openOptionsPage()
+})
+
+// --- Keepalive Alarm ---
+
+// An open WebSocket only survives while the worker does, so keep it alive just
+// under the 30s MV3 idle limit. With no socket to hold, a 1 minute alarm is
+// enough to drive reconnects and catch-up attaches.
+const KEEPALIVE_CONNECTED_MINUTES = 0.4
+const KEEPALIVE_IDLE_MINUTES = 1
+let keepalivePeriod = 0
+
+function updateKeepalive() {
+  const period = relayWs && relayWs.readyState === WebSocket.OPEN
+    ? KEEPALIVE_CONNECTED_MINUTES
+    : KEEPALIVE_IDLE_MINUTES
+  if (period === keepalivePeriod) return
+  keepalivePeriod = period
+  void chrome.alarms.create('relay-keepalive', { periodInMinutes: period })
+}
+
+updateKeepalive()
+// Full tab scan to correct any drift in unattachedTabs.
+chrome.alarms.create('relay-reconcile', { periodInMinutes: 10 })
+
+async function reconcileUnattachedTabs() {
+  const allTabs = await chrome.tabs.query({})
+  unattachedTabs.clear()
+  for (const tab of allTabs) {
+    if (tab.id) noteUnattached(tab.id, tab.url)
+  }
+}
+
+chrome.alarms.onAlarm.addListener(async (alarm) => {
+  if (alarm.name !== 'relay-keepalive' && alarm.name !== 'relay-reconcile') return
+  await initPromise
+
+  if (alarm.name === 'relay-reconcile') {
+    await reconcileUnattachedTabs()
+  }
+
+  updateGlobalBadge()
+
+  if (isAutoAttachEnabled()) {
+    const candidates = [...unattachedTabs]
+    void mapLimit(candidates, ATTACH_CONCURRENCY, ([tabId, url]) => autoAttachTab(tabId, url))
+  }
+
+  if (!relayWs || relayWs.readyState !== WebSocket.OPEN) {
+    if (!relayConnectPromise && !reconnectTimer) {
+      console.log('Keepalive: WebSocket unhealthy, triggering reconnect')
+      await ensureRelayConnection().catch(() => {
+        if (!reconnectTimer) scheduleReconnect()
+      })
+    }
+  }
+})
+
+// --- Message Handler (options page + status) ---
+
+const NO_HEADERS = {}
+/** @type {{key:string, promise:Promise<any>}|null} */
+let relayCheckInflight = null
+
+// Concurrent checks of the same url/token (status poll + save) share one fetch.
+// The timeout signal is per request: AbortSignal.timeout() can't be rearmed.
+function runRelayCheck(url, token) {
+  const key = `${url}\n${token || ''}`
+  if (relayCheckInflight?.key === key) return relayCheckInflight.promise
+
+  const headers = token ? { 'x-openclaw-relay-token': token } : NO_HEADERS
+  const promise = fetch(url, { method: 'GET', headers, signal: AbortSignal.timeout(2000) })
+    .then(async (res) => {
+      const contentType = String(res.headers.get('content-type') || '')
+      let json = null
+      if (contentType.includes('application/json')) {
+        try {
+          json = await res.json()
+        } catch {
+          json = null
+        }
+      }
+      return { status: res.status, ok: res.ok, contentType, json }
+    })
+    .catch((err) => ({ status: 0, ok: false, error: String(err) }))
+    .finally(() => {
+      if (relayCheckInflight?.promise === promise) relayCheckInflight = null
+    })
+  relayCheckInflight = { key, promise }
+  return promise
+}
+
+chrome.runtime.onMessage.addListener((msg, _sender, sendResponse) => {
+  if (msg?.type === 'getStatus') {
+    sendResponse(handleGetStatus())
+    return false
+  }
+
+  if (msg?.type === 'relayCheck') {
+    runRelayCheck(msg.url, msg.token).then(sendResponse)
+    return true
+  }
+
+  return false
+})
+
+// --- Initialization ---
+
+const initPromise = Promise.all([rehydrateState(), loadAutoAttachSetting()])
+  .then(() => reconcileUnattachedTabs())
+  .catch(() => {})
+
+let initDone = false
+initPromise.then(() => {
+  initDone = true
+})
+
+initPromise.then(async () => {
+  try {
+    await ensureRelayConnection()
+    reconnectAttempt = 0
+    if (tabs.size > 0) {
+      await reannounceAttachedTabs()
+    }
+    await autoAttachAllTabs()
+  } catch {
+    scheduleReconnect()
+    if (isAutoAttachEnabled()) {
+      try {
+        await autoAttachAllTabs()
+      } catch {
+        // Best effort
+      }
+    }
+  }
+})
+
+// Once init has settled, run listeners directly instead of paying a promise
+// and a microtask hop per event.
+function whenReady(fn) {
+  return initDone ? fn() : initPromise.then(fn)
+}